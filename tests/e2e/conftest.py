@@ -1,7 +1,9 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import hashlib
 import inspect
+import json
 import logging
 import os
 from pathlib import Path
@@ -32,7 +34,8 @@ def pytest_addoption(parser):
 @pytest.fixture(scope="module")
 async def rendered_bundle(ops_test: OpsTest, pytestconfig) -> Path:
     """Returns the pathlib.Path for the rendered bundle file."""
-    logger.info("Rendering bundle %s", get_this_script_dir() / ".." / ".." / "bundle.yaml.j2")
+    template = get_this_script_dir() / ".." / ".." / "bundle.yaml.j2"
+    logger.info("Rendering bundle %s", template)
 
     async def build_charm_if_is_dir(option: str) -> str:
         if Path(option).is_dir():
@@ -53,12 +56,26 @@ async def rendered_bundle(ops_test: OpsTest, pytestconfig) -> Path:
         "channel": pytestconfig.getoption("channel"),
     }
 
+    # The rendered bundle only depends on the template and the options, unless a charm is built
+    # from source, in which case the source may have changed since the last run.
+    cache_key = None
+    if not any(v is not None and Path(v).is_dir() for v in charms.values()):
+        digest = hashlib.blake2b(template.read_bytes())
+        digest.update(json.dumps({**charms, **additional_args}, sort_keys=True).encode())
+        cache_key = f"cos-lite/rendered-bundle/{digest.hexdigest()}"
+        if (cached := pytestconfig.cache.get(cache_key, None)) is not None:
+            logger.info("Reusing the bundle rendered in a previous run")
+            rendered_bundle = ops_test.tmp_path / "bundles" / template.stem
+            rendered_bundle.parent.mkdir(parents=True, exist_ok=True)
+            rendered_bundle.write_text(cached)
+            return rendered_bundle
+
     context = {k: await build_charm_if_is_dir(v) for k, v in charms.items() if v is not None}
     context.update(additional_args)
     logger.debug("context: %s", context)
 
-    rendered_bundle = ops_test.render_bundle(
-        get_this_script_dir() / ".." / ".." / "bundle.yaml.j2", context=context
-    )
+    rendered_bundle = ops_test.render_bundle(template, context=context)
+    if cache_key is not None:
+        pytestconfig.cache.set(cache_key, rendered_bundle.read_text())
 
     return rendered_bundle
@@ -1,7 +1,11 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import asyncio
+import json
 import logging
+import subprocess
+from typing import Callable, Dict
 
 from juju.controller import Controller
 from juju.model import Model
@@ -19,3 +23,49 @@ async def get_or_add_model(ops_test: OpsTest, controller: Controller, model_name
         )
 
     return await controller.get_model(model_name)
+
+
+async def get_proxied_endpoints(model: Model) -> Dict[str, str]:
+    """Returns the URLs assigned by Traefik, keyed by unit name (per-unit) or app name (per-app)."""
+    action = await model.applications["traefik"].units[0].run_action("show-proxied-endpoints")
+    action = await action.wait()
+    # Before deserialization, output looks like this:
+    # '{"prometheus/0": {"url": "http://10.1.2.3:80/model-prometheus-0"}, "grafana": {...}}'
+    proxied_endpoints = json.loads(action.results["proxied-endpoints"])
+    logger.debug("Endpoints proxied by traefik/0: %s", proxied_endpoints)
+    return {key: value["url"] for key, value in proxied_endpoints.items()}
+
+
+async def get_unit_address(model: Model, app_name: str, unit_num: int) -> str:
+    """Returns the address of a unit, as reported by juju status."""
+    status = await model.get_status()
+    return status["applications"][app_name]["units"][f"{app_name}/{unit_num}"]["address"]
+
+
+async def run_juju(*args: str) -> bytes:
+    """Run a juju CLI command without blocking the event loop and return its combined output.
+
+    Raises:
+        subprocess.CalledProcessError: if the command exits with a non-zero code.
+    """
+    cmd = ["juju", *args]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    output, _ = await proc.communicate()
+    if proc.returncode:
+        logger.error(output.decode())
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=output)
+    return output
+
+
+async def settle(model: Model, condition: Callable[[], bool], timeout: float = 120) -> None:
+    """Block until the condition holds, but only warn if it does not within the timeout.
+
+    Meant for teardown steps that juju does not always complete, so that we return as soon as
+    the model settles without failing the test when it never does.
+    """
+    try:
+        await model.block_until(condition, timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Model %s did not settle within %ss", model.name, timeout)
@@ -4,14 +4,24 @@
 """Metrics and logs from a machine charm are ingested over juju-info/cos_agent by COS Lite."""
 
 import asyncio
+import codecs
 import logging
 import os
-import subprocess
+from collections import Counter
 from types import SimpleNamespace
+from typing import Set, Tuple
 
+import aiohttp
 import pytest
-from helpers import get_or_add_model
+from helpers import (
+    get_or_add_model,
+    get_proxied_endpoints,
+    get_unit_address,
+    run_juju,
+    settle,
+)
 from juju.controller import Controller
+from juju.model import Model
 from pytest_operator.plugin import OpsTest
 
 logger = logging.getLogger(__name__)
@@ -20,12 +30,13 @@ agent = SimpleNamespace(charm="grafana-agent", name="agent")
 # TODO: increase scale to 2 when CI runners are more performant
 principal_cos_agent = SimpleNamespace(charm="zookeeper", name="principal-cos-agent", scale=1)
 principal_juju_info = SimpleNamespace(charm="ubuntu", name="principal-juju-info", scale=1)
+# Substrings identifying the dashboards the machine charms are expected to bring to grafana.
+expected_dashboards = ("zookeeper", "grafana-agent-node-exporter")
 
 
-@pytest.mark.abort_on_fail
-async def test_setup_models(ops_test: OpsTest):
-    global lxd_mdl, k8s_mdl, k8s_ctl
-
+@pytest.fixture(scope="module")
+async def juju_env(ops_test: OpsTest):
+    """Connect to both controllers and set up a model in each, once for the whole module."""
     lxd_ctl_name = os.environ["LXD_CONTROLLER"]
     k8s_ctl_name = os.environ["K8S_CONTROLLER"]
 
@@ -33,119 +44,210 @@ async def test_setup_models(ops_test: OpsTest):
     # Use the same model name in both controllers.
     k8s_mdl_name = lxd_mdl_name = ops_test.model_name
 
+    async def setup(ctl_name: str, mdl_name: str) -> Tuple[Controller, Model]:
+        ctl = Controller()
+        await ctl.connect(ctl_name)
+        mdl = await get_or_add_model(ops_test, ctl, mdl_name)
+        await mdl.set_config({"logging-config": "<root>=WARNING; unit=DEBUG"})
+        return ctl, mdl
+
     # We do not want to make assumptions here about the current controller.
-    # Assuming a k8s controller is ready and its name is stored in $LXD_CONTROLLER.
-    lxd_ctl = Controller()
-    await lxd_ctl.connect(lxd_ctl_name)
-    lxd_mdl = await get_or_add_model(ops_test, lxd_ctl, lxd_mdl_name)
-    await lxd_mdl.set_config({"logging-config": "<root>=WARNING; unit=DEBUG"})
+    # Assuming an lxd controller is ready and its name is stored in $LXD_CONTROLLER, and a k8s
+    # controller is ready and its name is stored in $K8S_CONTROLLER.
+    # The two controllers are independent, so set them up concurrently.
+    (lxd_ctl, lxd_mdl), (k8s_ctl, k8s_mdl) = await asyncio.gather(
+        setup(lxd_ctl_name, lxd_mdl_name),
+        setup(k8s_ctl_name, k8s_mdl_name),
+    )
+    yield SimpleNamespace(lxd_ctl=lxd_ctl, lxd_mdl=lxd_mdl, k8s_ctl=k8s_ctl, k8s_mdl=k8s_mdl)
 
-    # Assuming a k8s controller is ready and its name is stored in $K8S_CONTROLLER.
-    k8s_ctl = Controller()
-    await k8s_ctl.connect(k8s_ctl_name)
-    k8s_mdl = await get_or_add_model(ops_test, k8s_ctl, k8s_mdl_name)
-    await k8s_mdl.set_config({"logging-config": "<root>=WARNING; unit=DEBUG"})
+    await asyncio.gather(lxd_mdl.disconnect(), k8s_mdl.disconnect())
+    await asyncio.gather(lxd_ctl.disconnect(), k8s_ctl.disconnect())
 
 
 @pytest.mark.abort_on_fail
-async def test_deploy_cos(rendered_bundle):
+async def test_deploy_cos(juju_env, rendered_bundle):
     # Use CLI to deploy bundle until https://github.com/juju/python-libjuju/issues/816 is fixed.
     # await k8s_mdl.deploy(str(rendered_bundle), trust=True)
-    cmd = [
-        "juju",
+    # Until then, the CLI pays its own controller login, but at least run_juju does not block the
+    # event loop, so the connections already open in this module keep being serviced meanwhile.
+    await run_juju(
         "deploy",
         "--trust",
         "-m",
-        f"{k8s_ctl.controller_name}:{k8s_mdl.name}",
-        rendered_bundle,
+        f"{juju_env.k8s_ctl.controller_name}:{juju_env.k8s_mdl.name}",
+        str(rendered_bundle),
         "--overlay",
         "./overlays/offers-overlay.yaml",
-    ]
-    try:
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        logger.error(e.output.decode())
-        raise
+    )
 
 
 @pytest.mark.abort_on_fail
-async def test_deploy_machine_charms():
-    await asyncio.gather(
-        # Principal
+async def test_deploy_machine_charms(juju_env):
+    lxd_mdl = juju_env.lxd_mdl
+    # Principal
+    deploy_principal_cos_agent = asyncio.create_task(
         lxd_mdl.deploy(
             principal_cos_agent.charm,
             application_name=principal_cos_agent.name,
             num_units=principal_cos_agent.scale,
             series="jammy",
             channel="edge",
-        ),
-        # Principal 2
+        )
+    )
+    # Principal 2
+    deploy_principal_juju_info = asyncio.create_task(
         lxd_mdl.deploy(
             principal_juju_info.charm,
             application_name=principal_juju_info.name,
             num_units=principal_juju_info.scale,
             series="jammy",
-        ),
-        # Subordinate
+        )
+    )
+    # Subordinate
+    deploy_agent = asyncio.create_task(
         lxd_mdl.deploy(
             agent.charm,
             application_name=agent.name,
             num_units=0,
             series="jammy",
             channel="edge",
-        ),
+        )
     )
+
+    # Relate each principal as soon as it and the subordinate are deployed.
+    async def relate_when_deployed(principal_deploy: asyncio.Task, endpoint: str):
+        await asyncio.gather(principal_deploy, deploy_agent)
+        await lxd_mdl.add_relation(endpoint, agent.name)
+
     # Must relate the subordinate before any "wait for idle", because otherwise agent would be in
     # 'unknown' status.
-    await lxd_mdl.add_relation(f"{principal_cos_agent.name}:cos-agent", agent.name)
-    await lxd_mdl.add_relation(f"{principal_juju_info.name}:juju-info", agent.name)
-    await lxd_mdl.block_until(lambda: len(lxd_mdl.applications[agent.name].units) > 0)
+    relate_and_wait = asyncio.gather(
+        relate_when_deployed(deploy_principal_cos_agent, f"{principal_cos_agent.name}:cos-agent"),
+        relate_when_deployed(deploy_principal_juju_info, f"{principal_juju_info.name}:juju-info"),
+        lxd_mdl.block_until(
+            lambda: agent.name in lxd_mdl.applications
+            and len(lxd_mdl.applications[agent.name].units) > 0
+        ),
+    )
+    try:
+        await relate_and_wait
+    except BaseException:
+        # Do not leave deploys, relations or the unit wait running after the test has failed.
+        relate_and_wait.cancel()
+        for task in (deploy_principal_cos_agent, deploy_principal_juju_info, deploy_agent):
+            task.cancel()
+        raise
 
 
 @pytest.mark.abort_on_fail
-async def test_integration():
-    # The consumed endpoint names must match offers-overlay.yaml.
-    await asyncio.gather(
-        lxd_mdl.consume(
-            f"admin/{k8s_mdl.name}.prometheus-receive-remote-write",
-            application_alias="prometheus",
-            controller_name=k8s_ctl.controller_name,  # same as os.environ["K8S_CONTROLLER"]
-        ),
-        lxd_mdl.consume(
-            f"admin/{k8s_mdl.name}.loki-logging",
-            application_alias="loki",
-            controller_name=k8s_ctl.controller_name,  # same as os.environ["K8S_CONTROLLER"]
-        ),
-        lxd_mdl.consume(
-            f"admin/{k8s_mdl.name}.grafana-dashboards",
-            application_alias="grafana",
+async def test_integration(juju_env):
+    lxd_mdl, k8s_ctl, k8s_mdl = juju_env.lxd_mdl, juju_env.k8s_ctl, juju_env.k8s_mdl
+
+    async def consume_and_relate(offer: str, alias: str):
+        await lxd_mdl.consume(
+            f"admin/{k8s_mdl.name}.{offer}",
+            application_alias=alias,
             controller_name=k8s_ctl.controller_name,  # same as os.environ["K8S_CONTROLLER"]
-        ),
-    )
+        )
+        await lxd_mdl.add_relation(agent.name, alias)
 
+    # The consumed endpoint names must match offers-overlay.yaml.
+    # Consume and relate each offer independently.
     await asyncio.gather(
-        lxd_mdl.add_relation(agent.name, "prometheus"),
-        lxd_mdl.add_relation(agent.name, "loki"),
-        lxd_mdl.add_relation(agent.name, "grafana"),
+        consume_and_relate("prometheus-receive-remote-write", "prometheus"),
+        consume_and_relate("loki-logging", "loki"),
+        consume_and_relate("grafana-dashboards", "grafana"),
     )
 
+    # First, we wait for the critical phase to pass with raise_on_error=False.
+    # (In CI, using github runners, we often see unreproducible hook failures.)
     # `idle_period` needs to be greater than the scrape interval to make sure metrics ingested.
+    strict_idle_period = 10
+    try:
+        await asyncio.gather(
+            lxd_mdl.wait_for_idle(
+                status="active", timeout=1800, idle_period=90, raise_on_error=False
+            ),
+            k8s_mdl.wait_for_idle(
+                status="active", timeout=1800, idle_period=90, raise_on_error=False
+            ),
+        )
+    except asyncio.TimeoutError:
+        # Slow runner: let the strict pass below do the settling, within the longer timeout.
+        logger.warning("Models did not settle within 1800s; waiting longer for 'active'")
+        strict_idle_period = 90
+
+    # Then a short strict pass, without raise_on_error=False, so the test fails sooner in case
+    # there is a persistent error status, and names the offending unit.
     await asyncio.gather(
-        # First, we wait for the critical phase to pass with raise_on_error=False.
-        # (In CI, using github runners, we often see unreproducible hook failures.)
-        lxd_mdl.wait_for_idle(timeout=1800, idle_period=180, raise_on_error=False),
-        k8s_mdl.wait_for_idle(timeout=1800, idle_period=180, raise_on_error=False),
+        lxd_mdl.wait_for_idle(status="active", timeout=7200, idle_period=strict_idle_period),
+        k8s_mdl.wait_for_idle(status="active", timeout=7200, idle_period=strict_idle_period),
     )
 
-    await asyncio.gather(
-        # Then we wait for "active", without raise_on_error=False, so the test fails sooner in case
-        # there is a persistent error status.
-        lxd_mdl.wait_for_idle(status="active", timeout=7200, idle_period=180),
-        k8s_mdl.wait_for_idle(status="active", timeout=7200, idle_period=180),
+
+@pytest.fixture(scope="module")
+async def grafana_admin_password(juju_env) -> str:
+    """Fetch the grafana admin password once per module instead of once per query."""
+    action = (
+        await juju_env.k8s_mdl.applications["grafana"].units[0].run_action("get-admin-password")
     )
+    action = await action.wait()
+    return action.results["admin-password"]
+
+
+@pytest.fixture(scope="module")
+async def http_session():
+    """A single HTTP session, so that all queries to COS reuse its connections."""
+    connector = aiohttp.TCPConnector(limit=10, keepalive_timeout=30)
+    async with aiohttp.ClientSession(connector=connector, raise_for_status=True) as session:
+        yield session
+
+
+@pytest.fixture(scope="module")
+async def cos_responses(juju_env, http_session, grafana_admin_password):
+    """Query prometheus, loki and grafana concurrently, once for all the tests that inspect them."""
+    proxied_endpoints = await get_proxied_endpoints(juju_env.k8s_mdl)
+
+    async def get_units_per_app(url: str) -> Counter:
+        """Tally the values of the `juju_unit` label by application name."""
+        async with http_session.get(url) as response:
+            # Loki omits "data" altogether when there are no values yet.
+            label_values = (await response.json()).get("data", [])
+        logger.info("Label values from %s: %s", url, label_values)
+        return Counter(value.split("/")[0] for value in label_values)
+
+    async def find_dashboards() -> Set[str]:
+        """Scan the dashboard search for the expected dashboards, stopping once all are seen."""
+        found: Set[str] = set()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        # Keep enough of the previous chunk to catch a name split across two chunks.
+        overlap = max(len(dashboard) for dashboard in expected_dashboards) - 1
+        tail = ""
+        # Grafana is behind a traefik-route, which show-proxied-endpoints does not list, so talk
+        # to the unit directly. Grafana uses strip_prefix, so no path prefix is needed there.
+        address = await get_unit_address(juju_env.k8s_mdl, "grafana", 0)
+        async with http_session.get(
+            f"http://{address}:3000/api/search",
+            auth=aiohttp.BasicAuth("admin", grafana_admin_password),
+        ) as response:
+            async for chunk in response.content.iter_chunked(4096):
+                text = tail + decoder.decode(chunk)
+                found.update(dashboard for dashboard in expected_dashboards if dashboard in text)
+                if found.issuperset(expected_dashboards):
+                    break
+                tail = text[-overlap:]
+        return found
+
+    prometheus, loki, grafana = await asyncio.gather(
+        get_units_per_app(f"{proxied_endpoints['prometheus/0']}/api/v1/label/juju_unit/values"),
+        get_units_per_app(f"{proxied_endpoints['loki/0']}/loki/api/v1/label/juju_unit/values"),
+        find_dashboards(),
+    )
+    return SimpleNamespace(prometheus=prometheus, loki=loki, grafana=grafana)
 
 
-async def test_metrics(ops_test):
+async def test_metrics(cos_responses):
     """Make sure machine charm metrics reach Prometheus."""
     # Get the values of all `juju_unit` labels in prometheus
     # Output looks like this:
@@ -156,28 +258,13 @@ async def test_metrics(ops_test):
     #  "principal-juju-info/0","principal-juju-info/1",
     #  "prometheus-k8s","traefik/0"
     # ]}
-    cmd = [
-        "juju",
-        "ssh",
-        "-m",
-        f"{k8s_ctl.controller_name}:{k8s_mdl.name}",
-        "prometheus/0",
-        "curl",
-        "localhost:9090/api/v1/label/juju_unit/values",
-    ]
-    try:
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        logger.error(e.stdout.decode())
-        raise
-    output = result.stdout.decode().strip()
-    logger.info("Label values: %s", output)
-    assert output.count(principal_cos_agent.name) == principal_cos_agent.scale
-    assert output.count(principal_juju_info.name) == principal_juju_info.scale
-    assert output.count(agent.name) >= principal_cos_agent.scale + principal_juju_info.scale
+    units_per_app = cos_responses.prometheus
+    assert units_per_app[principal_cos_agent.name] == principal_cos_agent.scale
+    assert units_per_app[principal_juju_info.name] == principal_juju_info.scale
+    assert units_per_app[agent.name] >= principal_cos_agent.scale + principal_juju_info.scale
 
 
-async def test_logs(ops_test):
+async def test_logs(cos_responses):
     """Make sure machine charm logs reach Loki."""
     # Get the values of all `juju_unit` labels in loki
     # Loki uses strip_prefix, so we do need to use the ingress path
@@ -186,36 +273,14 @@ async def test_logs(ops_test):
     #  "principal-cos-agent/2","principal-cos-agent/3",
     #  "principal-juju-info/0","principal-juju-info/1"
     # ]}
-    cmd = [
-        "juju",
-        "ssh",
-        "-m",
-        f"{k8s_ctl.controller_name}:{k8s_mdl.name}",
-        "loki/0",
-        "curl",
-        "localhost:3100/loki/api/v1/label/juju_unit/values",
-    ]
-    try:
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        logger.error(e.stdout.decode())
-        raise
-
-    output = result.stdout.decode().strip()
-    logger.info("Label values: %s", output)
-    assert output.count(principal_cos_agent.name) == principal_cos_agent.scale
-    assert output.count(principal_juju_info.name) == principal_juju_info.scale
-
+    units_per_app = cos_responses.loki
+    assert units_per_app[principal_cos_agent.name] == principal_cos_agent.scale
+    assert units_per_app[principal_juju_info.name] == principal_juju_info.scale
 
-async def test_dashboards(ops_test):
-    # Get grafana admin password
-    action = await k8s_mdl.applications["grafana"].units[0].run_action("get-admin-password")
-    action = await action.wait()
-    password = action.results["admin-password"]
 
+async def test_dashboards(cos_responses):
     # Get all dashboards
-    # Grafana uses strip_prefix, so we do need to use the ingress path
-    # Output looks like this:
+    # The search response looks like this (it is only scanned for the expected dashboards):
     # [
     #  {"id":6,"uid":"exunkijMk","title":"Grafana Agent Node Exporter Quickstart",
     #   "uri":"db/grafana-agent-node-exporter-quickstart",
@@ -229,51 +294,40 @@ async def test_dashboards(ops_test):
     #   "url":"/cos-grafana/d/SDE76m7Zzz/zookeeper-by-prometheus","slug":"","type":"dash-db",
     #   "tags":["v4"],"isStarred":false,"sortMeta":0}
     # ]
-    cmd = [
-        "juju",
-        "ssh",
-        "-m",
-        f"{k8s_ctl.controller_name}:{k8s_mdl.name}",
-        "grafana/0",
-        "curl",
-        "--user",
-        f"admin:{password}",
-        "localhost:3000/api/search",
-    ]
-    try:
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        logger.error(e.stdout.decode())
-        raise
-
-    output = result.stdout.decode().strip()
-    assert "zookeeper" in output
-    assert "grafana-agent-node-exporter" in output
+    found = cos_responses.grafana
+    logger.info("Dashboards found: %s", found)
+    for dashboard in expected_dashboards:
+        assert dashboard in found
 
 
-async def test_destroy(ops_test):
+async def test_destroy(ops_test, juju_env):
     if ops_test.keep_model:
         return
 
+    lxd_mdl, k8s_mdl = juju_env.lxd_mdl, juju_env.k8s_mdl
+
+    machine_apps = {agent.name, principal_cos_agent.name, principal_juju_info.name}
+    saas = {"prometheus", "loki", "grafana"}
+
     # First, must remove the machine charms and saas, otherwise:
     # ERROR cannot destroy application "grafana": application is used by 3 consumers
     # Do not `block_until_done=True` because of the juju bug where teardown never completes.
+    # The removals do not depend on each other, so issue them all at once.
     await asyncio.gather(
-        lxd_mdl.remove_application(agent.name),
-        lxd_mdl.remove_application(principal_cos_agent.name),
-        lxd_mdl.remove_application(principal_juju_info.name),
+        *(lxd_mdl.remove_application(app) for app in machine_apps),
+        *(lxd_mdl.remove_saas(name) for name in saas),
     )
-    await asyncio.gather(
-        lxd_mdl.remove_saas("prometheus"),
-        lxd_mdl.remove_saas("loki"),
-        lxd_mdl.remove_saas("grafana"),
+    # Wait for the removals to show in the model, but only warn on timeout: because of the juju
+    # teardown bug, they may never complete.
+    await settle(
+        lxd_mdl,
+        lambda: machine_apps.isdisjoint(lxd_mdl.applications)
+        and saas.isdisjoint(lxd_mdl.remote_applications),
     )
-    # Give it some time to settle, since we cannot block until complete.
-    await asyncio.sleep(60)
 
     # Now remove traefik politely to avoid IP binding issues in the next test
     await k8s_mdl.remove_application("traefik")
-    # Give it some time to settle, since we cannot block until complete.
-    await asyncio.sleep(60)
+    # Likewise, wait for traefik to be gone, but only warn on timeout.
+    await settle(k8s_mdl, lambda: "traefik" not in k8s_mdl.applications)
 
     # The rest can be forcefully removed by pytest-operator.